@@ -44,6 +44,11 @@ def parse_args():
                         nargs='+',
                         help='Where to save the vocoded audio')
 
+    # Parallelization
+    parser.add_argument('--num_workers',
+                        type=int,
+                        help='The number of worker processes')
+
     return parser.parse_args()
 
 
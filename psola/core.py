@@ -1,12 +1,12 @@
-import functools
+import concurrent.futures
+import itertools
+import multiprocessing
 import os
-import tempfile
 
 import numpy as np
-import pypar
-import soundfile
-import tqdm
-from parselmouth import Data, praat, Sound
+
+# Heavy dependencies (parselmouth, pypar, soundfile, tqdm) are imported
+# within the functions that use them to keep import of this module fast
 
 
 __all__ = ['FMAX',
@@ -63,6 +63,9 @@ def from_file(audio_file,
         sample_rate : int
             The audio sampling rate
     """
+    import pypar
+    import soundfile
+
     # Load inputs from file
     audio, sample_rate = soundfile.read(audio_file)
     source_alignment = None if source_alignment_file is None \
@@ -70,7 +73,7 @@ def from_file(audio_file,
     target_alignment = None if target_alignment_file is None \
         else pypar.Alignment(target_alignment_file)
     target_pitch = None if target_pitch_file is None \
-        else np.load(target_pitch_file)
+        else np.load(target_pitch_file, mmap_mode='r')
 
     # Vocode
     audio = vocode(audio,
@@ -133,7 +136,8 @@ def from_files_to_files(audio_files,
                         target_pitch_files=None,
                         constant_stretch=None,
                         fmin=FMIN,
-                        fmax=FMAX):
+                        fmax=FMAX,
+                        num_workers=None):
     """Performs vocoding using Praat and save to disk
 
     Arguments
@@ -153,7 +157,17 @@ def from_files_to_files(audio_files,
             The minimum allowable frequency in Hz.
         fmax : int
             The maximum allowable frequency in Hz.
+        num_workers : int or None
+            The number of worker processes. Defaults to the number of cpus.
     """
+    import soundfile
+    import tqdm
+
+    # Load the heavy worker dependencies before the pool is created so
+    # forked workers inherit them instead of re-importing per worker
+    import parselmouth
+    import pypar
+
     # Expand None-valued defaults
     if source_alignment_files is None:
         source_alignment_files = [None] * len(audio_files)
@@ -162,23 +176,56 @@ def from_files_to_files(audio_files,
     if target_pitch_files is None:
         target_pitch_files = [None] * len(audio_files)
 
-    # Bind static parameters
-    vocode_fn = functools.partial(from_file_to_file,
-                                  constant_stretch=constant_stretch,
-                                  fmin=fmin,
-                                  fmax=fmax)
-
-    # Setup iterator
-    iterator = zip(audio_files,
-                   output_files,
-                   source_alignment_files,
-                   target_alignment_files,
-                   target_pitch_files)
-    iterator = tqdm.tqdm(iterator, desc='psola', dynamic_ncols=True)
-    for item in iterator:
-
-        # Vocode and save to disk
-        vocode_fn(*item)
+    # Dispatch the longest files first so short files backfill workers
+    # that finish early. Reading the duration only parses the header.
+    if audio_files:
+        (audio_files,
+         output_files,
+         source_alignment_files,
+         target_alignment_files,
+         target_pitch_files) = zip(*sorted(
+            zip(audio_files,
+                output_files,
+                source_alignment_files,
+                target_alignment_files,
+                target_pitch_files),
+            key=lambda item: soundfile.info(item[0]).duration,
+            reverse=True))
+
+    # Each file is vocoded independently, and Praat does not reliably
+    # release the GIL, so we parallelize over processes rather than threads
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    # Fork workers where available so they inherit the already-imported
+    # parselmouth and numpy instead of re-importing them. Platforms
+    # without fork (e.g., Windows) fall back to spawning.
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = None
+
+    with concurrent.futures.ProcessPoolExecutor(
+            num_workers, mp_context=context) as executor:
+
+        # Vocode and save to disk, repeating static parameters rather
+        # than dispatching through functools.partial
+        iterator = executor.map(from_file_to_file,
+                                audio_files,
+                                output_files,
+                                source_alignment_files,
+                                target_alignment_files,
+                                target_pitch_files,
+                                itertools.repeat(constant_stretch),
+                                itertools.repeat(fmin),
+                                itertools.repeat(fmax))
+        iterator = tqdm.tqdm(iterator,
+                             desc='psola',
+                             dynamic_ncols=True,
+                             mininterval=.5,
+                             total=len(audio_files))
+        for _ in iterator:
+            pass
 
 
 def to_file(audio,
@@ -257,26 +304,47 @@ def vocode(audio,
         audio : np.array(shape=(samples,))
             The vocoded audio
     """
-    with tempfile.TemporaryDirectory() as tmpdir:
+    import pypar
+    from parselmouth import praat
+
+    # Praat stores samples as contiguous float64; coercing here avoids a
+    # hidden copy when the Sound is constructed
+    audio = np.ascontiguousarray(audio, dtype=np.float64)
+
+    # Whether to time-stretch
+    stretch = constant_stretch is not None or \
+       (isinstance(source_alignment, pypar.Alignment) and \
+        isinstance(target_alignment, pypar.Alignment))
+
+    # Whether to pitch-shift
+    shift = target_pitch is not None
+
+    if stretch or shift:
+
+        # Open one manipulation context shared by both transforms so
+        # the analysis is not repeated
+        manipulation = get_manipulation(audio, fmin, fmax, sample_rate)
+
         # Time-stretch
-        if constant_stretch is not None or \
-           (isinstance(source_alignment, pypar.Alignment) and \
-            isinstance(target_alignment, pypar.Alignment)):
-            audio = time_stretch(audio,
-                                 source_alignment,
-                                 target_alignment,
-                                 constant_stretch,
-                                 fmin,
-                                 fmax,
-                                 sample_rate,
-                                 tmpdir)
+        if stretch:
+            time_stretch(manipulation,
+                         audio,
+                         source_alignment,
+                         target_alignment,
+                         constant_stretch,
+                         sample_rate)
 
         # Pitch-shift
-        if target_pitch is not None:
-            audio = pitch_shift(
-                audio, target_pitch, fmin, fmax, sample_rate, tmpdir)
+        if shift:
+            pitch_shift(manipulation, audio, target_pitch, sample_rate)
 
-        return audio
+        # Resynthesize. Praat computes in float64, but float32 is more
+        # than sufficient for 16-bit source audio and halves the output.
+        audio = praat.call(
+            manipulation,
+            "Get resynthesis (overlap-add)").values[0].astype(np.float32)
+
+    return audio
 
 
 ###############################################################################
@@ -284,7 +352,47 @@ def vocode(audio,
 ###############################################################################
 
 
-def get_manipulation(audio, fmin, fmax, sample_rate, tmpdir):
+def get_duration_tier(times, rates, eps=1e-6):
+    """Create a praat duration tier from phoneme times and rates
+
+    Arguments
+        times : np.array(shape=(phonemes + 1,))
+            The original start and end times of each phoneme
+        rates : np.array(shape=(phonemes,))
+            The relative speed of each phoneme
+        eps : float
+            Distance in seconds between two control points at a discontinuity
+
+    Returns
+        duration_tier : parselmouth.Data
+            The praat duration tier
+    """
+    from parselmouth import praat
+
+    duration_tier = praat.call(
+        "Create DurationTier", "duration", 0., times[-1])
+
+    # Start at the original rate
+    praat.call(duration_tier, "Add point", 0., 1.)
+
+    # Interleave the adjusted phoneme boundaries. We need 2 points per
+    # phoneme to create a discontinuity in the automation curve.
+    points = np.empty(2 * len(rates))
+    points[0::2] = times[:-1] + eps
+    points[1::2] = times[1:] - eps
+    values = np.repeat(rates, 2)
+
+    # Add the new rate of each phoneme
+    for time, value in zip(points.tolist(), values.tolist()):
+        praat.call(duration_tier, "Add point", time, value)
+
+    # End at the original rate
+    praat.call(duration_tier, "Add point", times[-1], 1.)
+
+    return duration_tier
+
+
+def get_manipulation(audio, fmin, fmax, sample_rate):
     """Retrieve a praat manipulation context
 
     Arguments
@@ -296,82 +404,91 @@ def get_manipulation(audio, fmin, fmax, sample_rate, tmpdir):
             The maximum allowable frequency in Hz.
         sample_rate : int
             The audio sampling rate
-        tmpdir : string
-            Directory to save intermediate values
 
     Returns
         manipulation : parselmouth.Data
             The praat manipulation context
     """
-    # Write audio to disk
-    audio_file = os.path.join(tmpdir, 'audio.wav')
-    save(audio_file, audio, sample_rate)
+    from parselmouth import praat, Sound
+
+    # Wrap audio in a praat sound without a disk round-trip
+    sound = Sound(audio, sampling_frequency=sample_rate)
 
     # Setup the source utterance for modulation
-    return praat.call(
-        Sound(audio_file), "To Manipulation", 1e-3, fmin, fmax)
+    return praat.call(sound, "To Manipulation", 1e-3, fmin, fmax)
+
+
+def get_pitch_tier(pitch, duration):
+    """Create a praat pitch tier from a pitch contour
+
+    Arguments
+        pitch : np.array(shape=(frames,))
+            The pitch contour to use for synthesis
+        duration : float
+            The duration of the audio in seconds
+
+    Returns
+        pitch_tier : parselmouth.Data
+            The praat pitch tier
+    """
+    from parselmouth import praat
+
+    times = np.linspace(0., duration, len(pitch))
+
+    # Select voiced frames. Praat cannot resynthesize from 0 Hz control
+    # points. Comparison with nan is False, so nans are also filtered.
+    voiced = pitch > 0.
+    times, pitch = times[voiced].tolist(), pitch[voiced].tolist()
 
+    pitch_tier = praat.call("Create PitchTier", "pitch", 0., duration)
 
-def pitch_shift(audio, pitch, fmin, fmax, sample_rate, tmpdir):
+    # Add one control point per voiced frame
+    for time, value in zip(times, pitch):
+        praat.call(pitch_tier, "Add point", time, value)
+
+    return pitch_tier
+
+
+def pitch_shift(manipulation, audio, pitch, sample_rate):
     """Perform praat pitch shifting on the manipulation
 
     Arguments
+        manipulation : parselmouth.Data
+            The praat manipulation context
         audio : np.array(shape=(samples,))
             The speech signal to process
         pitch : np.array(shape=(frames,))
             The target pitch contour
-        fmin : int
-            The minimum allowable frequency in Hz.
-        fmax : int
-            The maximum allowable frequency in Hz.
         sample_rate : int
             The audio sampling rate
-        tmpdir : string
-            Directory to save intermediate values
-
-    Returns
-        audio : np.array(shape=(samples,))
-            The pitch-shifted audio
     """
-    # Don't edit in-place
-    pitch = np.copy(pitch)
-
-    # Convert unvoiced tokens to 0.
-    pitch[np.isnan(pitch)] = 0.
+    from parselmouth import praat
 
-    # Write pitch to disk
-    pitch_file = os.path.join(tmpdir, 'pitch.txt')
-    write_pitch_tier(pitch_file, pitch, float(len(audio)) / sample_rate)
-
-    # Read pitch file into praat
-    pitch_tier = Data.read(pitch_file)
-
-    # Open a praat manipulation context
-    manipulation = get_manipulation(audio, fmin, fmax, sample_rate, tmpdir)
+    # Create pitch tier. Unvoiced (nan) frames are filtered during tier
+    # creation, so no copy is needed here.
+    pitch_tier = get_pitch_tier(pitch, float(len(audio)) / sample_rate)
 
     # Replace source pitch with new pitch
     praat.call([pitch_tier, manipulation], "Replace pitch tier")
 
-    # Resynthesize
-    return praat.call(manipulation, "Get resynthesis (overlap-add)").values[0]
-
 
 def save(file, audio, sample_rate):
     """Save audio to disk"""
+    import soundfile
     soundfile.write(file, audio, sample_rate)
 
 
-def time_stretch(audio,
+def time_stretch(manipulation,
+                 audio,
                  alignment,
                  target_alignment,
                  constant_stretch,
-                 fmin,
-                 fmax,
-                 sample_rate,
-                 tmpdir):
+                 sample_rate):
     """Perform praat time stretching on the manipulation
 
     Arguments
+        manipulation : parselmouth.Data
+            The praat manipulation context
         audio : np.array(shape=(samples,))
             The speech signal to process
         alignment : pypar.Alignment
@@ -380,19 +497,12 @@ def time_stretch(audio,
             The target alignment if performing time-stretching
         constant_stretch : float or None
             A constant value for time-stretching
-        fmin : int
-            The minimum allowable frequency in Hz.
-        fmax : int
-            The maximum allowable frequency in Hz.
         sample_rate : int
             The audio sampling rate
-        tmpdir : string
-            Directory to save intermediate values
-
-    Returns
-        audio : np.array(shape=(samples,))
-            The time-stretched audio
     """
+    import pypar
+    from parselmouth import praat
+
     if constant_stretch is not None:
         # Audio start and end time
         times = np.array([0., len(audio) / sample_rate])
@@ -402,101 +512,20 @@ def time_stretch(audio,
 
     else:
         # Phoneme start and end times
-        times = np.array(
-            [phoneme.start() for phoneme in alignment.phonemes()] +
-            [alignment.end()])
+        phonemes = alignment.phonemes()
+        times = np.fromiter(
+            itertools.chain(
+                (phoneme.start() for phoneme in phonemes),
+                [alignment.end()]),
+            dtype=np.float64,
+            count=len(phonemes) + 1)
 
         # Relative phoneme speeds
         rates = pypar.compare.per_phoneme_rate(alignment, target_alignment)
-        rates = np.array(rates)
-        rates[rates < .0625] = .0625
+        rates = np.maximum(np.asarray(rates, dtype=np.float64), .0625)
 
-    # Write duration to disk
-    duration_file = os.path.join(tmpdir, 'duration.txt')
-    write_duration_tier(duration_file, times, rates)
-
-    # Read duration file into praat
-    duration_tier = Data.read(duration_file)
-
-    # Open a praat manipulation context
-    manipulation = get_manipulation(audio, fmin, fmax, sample_rate, tmpdir)
+    # Create duration tier
+    duration_tier = get_duration_tier(times, rates)
 
     # Replace phoneme durations
     praat.call([duration_tier, manipulation], 'Replace duration tier')
-
-    # Resynthesize
-    return praat.call(manipulation, "Get resynthesis (overlap-add)").values[0]
-
-
-def write_duration_tier(filename, times, rates, eps=1e-6):
-    """Write a duration tier to disk that is readable by praat
-
-    Arguments
-        filename : string
-            Where to write the duration file
-        times : np.array(shape=(phonemes + 1,))
-            The original start and end times of each phoneme
-        rates : np.array(shape=(phonemes,))
-            The relative speed of the phoneme
-        duration : float
-            The duration of the audio in seconds
-        eps : float
-            Distance in seconds between two control points at a discontinuity
-    """
-    with open(filename, 'w') as file:
-        # Write the header
-        file.write(
-            'File type = "ooTextFile"\nObject class = "DurationTier"\n\n')
-
-        # Write the start and end of the audio file
-        file.write(
-            f'xmin = 0.000000\nxmax = {times[-1]:.6f}\npoints: size = {2 * len(times)}\n')
-
-        # Start at the original rate
-        file.write('points [1]:\n\tnumber = 0\n\tvalue = 1.000000\n')
-
-        # Write the new duration
-        for i, (start, end, rate) in enumerate(zip(times[:-1], times[1:], rates)):
-
-            # We need 2 points to create a discontinuity in the automation curve
-            file.write(f'points [{2 * i + 2}]:\n' +
-                       f'\tnumber = {start + eps:.6f}\n' +
-                       f'\tvalue = {rate:.6f}\n')
-            file.write(f'points [{2 * i + 3}]:\n' +
-                       f'\tnumber = {end - eps:.6f}\n' +
-                       f'\tvalue = {rate:.6f}\n')
-
-        # End at the original rate
-        file.write(f'points [{2 * len(times)}]:\n' +
-                   f'\tnumber = {times[-1]:.6f}\n' +
-                   '\tvalue = 1.000000\n')
-
-
-def write_pitch_tier(filename, pitch, duration):
-    """
-    Write a pitch tier to disk that is readable by praat
-
-    Arguments
-        filename : string
-            Where to write the pitch file
-        pitch : np.array
-            The new pitch contour to use for synthesis
-        duration : float
-            The duration of the audio in seconds
-    """
-    times = np.linspace(0., duration, len(pitch))
-    with open(filename, 'w') as file:
-        # Write the header
-        file.write('File type = "ooTextFile"\nObject class = "PitchTier"\n\n')
-
-        # Write the start and end of the audio file
-        file.write('0\n')
-        file.write(str(duration) + '\n')
-
-        # Write the number of voiced frames
-        file.write(str(np.sum(~np.isnan(pitch))) + '\n')
-
-        # Write the pitch values and time points
-        for time, value in zip(times, pitch):
-            if not np.isnan(value):
-                file.write(str(time) + '\n' + str(value) + '\n')